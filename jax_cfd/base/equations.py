@@ -14,7 +14,8 @@
 
 """Examples of defining equations."""
 import functools
-from typing import Callable, Optional
+import operator
+from typing import Callable, Optional, Tuple
 
 import jax
 import jax.numpy as jnp
@@ -38,8 +39,31 @@ DiffuseFn = Callable[[GridVariable, float], GridArray]
 ForcingFn = Callable[[GridVariableVector], GridArrayVector]
 
 
+# velocity magnitude below which advection is ignored by `dynamic_time_step`
+_MIN_VELOCITY = 1e-12
+
+
 def sum_fields(*args):
-  return jax.tree.map(lambda *a: sum(a), *args)
+  return jax.tree.map(lambda *a: functools.reduce(operator.add, a), *args)
+
+
+def _stable_time_step_constants(
+    max_courant_number: float,
+    viscosity: float,
+    grid: grids.Grid,
+    implicit_diffusion: bool,
+) -> Tuple[float, Optional[float]]:
+  """Returns the advection time step at unit velocity and the diffusion step."""
+  advection_dt = advection.stable_time_step(1, max_courant_number, grid)
+  if implicit_diffusion:
+    diffusion_dt = None
+  else:
+    diffusion_dt = diffusion.stable_time_step(viscosity, grid)
+  return advection_dt, diffusion_dt
+
+
+_cached_stable_time_step_constants = functools.lru_cache(maxsize=None)(
+    _stable_time_step_constants)
 
 
 def stable_time_step(
@@ -50,12 +74,18 @@ def stable_time_step(
     implicit_diffusion: bool = False,
 ) -> float:
   """Calculate a stable time step for Navier-Stokes."""
-  dt = advection.stable_time_step(max_velocity, max_courant_number, grid)
-  if not implicit_diffusion:
-    diffusion_dt = diffusion.stable_time_step(viscosity, grid)
-    if diffusion_dt < dt:
-      raise ValueError(f'stable time step for diffusion is smaller than '
-                       f'the chosen timestep: {diffusion_dt} vs {dt}')
+  args = (max_courant_number, viscosity, grid, implicit_diffusion)
+  try:
+    hash(args)
+  except TypeError:
+    # array or traced arguments can't be cached
+    advection_dt, diffusion_dt = _stable_time_step_constants(*args)
+  else:
+    advection_dt, diffusion_dt = _cached_stable_time_step_constants(*args)
+  dt = advection_dt / max_velocity
+  if diffusion_dt is not None and diffusion_dt < dt:
+    raise ValueError(f'stable time step for diffusion is smaller than '
+                     f'the chosen timestep: {diffusion_dt} vs {dt}')
   return dt
 
 
@@ -65,11 +95,27 @@ def dynamic_time_step(v: GridVariableVector,
                       grid: grids.Grid,
                       implicit_diffusion: bool = False) -> float:
   """Pick a dynamic time-step for Navier-Stokes based on stable advection."""
-  v_max = jnp.sqrt(jnp.max(sum(u.data ** 2 for u in v)))
+  stacked = jnp.stack([u.data for u in v])
+  v_max = jnp.sqrt(jnp.max(jnp.sum(jnp.square(stacked), axis=0)))
+  if not implicit_diffusion and v_max < _MIN_VELOCITY:
+    # advection doesn't constrain the time step of a (nearly) still fluid
+    return diffusion.stable_time_step(viscosity, grid)
+  v_max = jnp.maximum(v_max, _MIN_VELOCITY)
   return stable_time_step(  # pytype: disable=wrong-arg-types  # jax-types
       v_max, max_courant_number, viscosity, grid, implicit_diffusion)
 
 
+def _default_convect(dt: float) -> ConvectFn:
+  """Returns Van-Leer convection of velocity with time step `dt`."""
+  def convect(v):
+    return tuple(
+        advection.advect_van_leer_using_limiters(u, v, dt) for u in v)
+  return convect
+
+
+_pressure_projection = jax.named_call(pressure.projection, name='pressure')
+
+
 def _wrap_term_as_vector(fun, *, name):
   return tree_math.unwrap(jax.named_call(fun, name=name), vector_argnums=0)
 
@@ -87,9 +133,7 @@ def navier_stokes_explicit_terms(
   del grid  # unused
 
   if convect is None:
-    def convect(v):  # pylint: disable=function-redefined
-      return tuple(
-          advection.advect_van_leer_using_limiters(u, v, dt) for u in v)
+    convect = _default_convect(dt)
 
   def diffuse_velocity(v, *args):
     return tuple(diffuse(u, *args) for u in v)
@@ -98,15 +142,17 @@ def navier_stokes_explicit_terms(
   diffusion_ = _wrap_term_as_vector(diffuse_velocity, name='diffusion')
   if forcing is not None:
     forcing = _wrap_term_as_vector(forcing, name='forcing')
+  inv_density = 1 / density
+  nu = viscosity / density if viscosity is not None else None
 
   @tree_math.wrap
   @functools.partial(jax.named_call, name='navier_stokes_momentum')
   def _explicit_terms(v):
     dv_dt = convection(v)
     if viscosity is not None:
-      dv_dt += diffusion_(v, viscosity / density)
+      dv_dt += diffusion_(v, nu)
     if forcing is not None:
-      dv_dt += forcing(v) / density
+      dv_dt += forcing(v) * inv_density
     return dv_dt
 
   def explicit_terms_with_same_bcs(v):
@@ -139,13 +185,11 @@ def semi_implicit_navier_stokes(
       diffuse=diffuse,
       forcing=forcing)
 
-  pressure_projection = jax.named_call(pressure.projection, name='pressure')
-
   # TODO(jamieas): Consider a scheme where pressure calculations and
   # advection/diffusion are staggered in time.
   ode = time_stepping.ExplicitNavierStokesODE(
       explicit_terms,
-      lambda v: pressure_projection(v, pressure_solve)
+      lambda v: _pressure_projection(v, pressure_solve)
   )
   step_fn = time_stepper(ode, dt)
   return step_fn
@@ -164,31 +208,26 @@ def implicit_diffusion_navier_stokes(
   """Returns a function that performs a time step of Navier Stokes."""
   del grid  # unused
   if convect is None:
-    def convect(v):  # pylint: disable=function-redefined
-      return tuple(
-          advection.advect_van_leer_using_limiters(u, v, dt) for u in v)
+    convect = _default_convect(dt)
 
   convect = jax.named_call(convect, name='convection')
-  pressure_projection = jax.named_call(pressure.projection, name='pressure')
   diffusion_solve = jax.named_call(diffusion_solve, name='diffusion')
+  inv_density = 1 / density
 
   # TODO(shoyer): refactor to support optional higher-order time integators
   @jax.named_call
   def navier_stokes_step(v: GridVariableVector) -> GridVariableVector:
     """Computes state at time `t + dt` using first order time integration."""
-    convection = convect(v)
-    accelerations = [convection]
+    dvdt = convect(v)
     if forcing is not None:
       # TODO(shoyer): include time in state?
-      f = forcing(v)
-      accelerations.append(tuple(f / density for f in f))
-    dvdt = sum_fields(*accelerations)
+      dvdt = tuple(a + f * inv_density for a, f in zip(dvdt, forcing(v)))
     # Update v by taking a time step
     v = tuple(
         grids.GridVariable(u.array + dudt * dt, u.bc)
         for u, dudt in zip(v, dvdt))
     # Pressure projection to incompressible velocity field
-    v = pressure_projection(v, pressure_solve)
+    v = _pressure_projection(v, pressure_solve)
     # Solve for implicit diffusion
     v = diffusion_solve(v, viscosity, dt)
     return v
@@ -17,6 +17,7 @@
 from absl.testing import absltest
 from absl.testing import parameterized
 
+import jax
 import jax.numpy as jnp
 from jax_cfd.base import advection
 from jax_cfd.base import boundaries
@@ -162,6 +163,16 @@ class SemiImplicitNavierStokesTest(test_util.TestCase):
     self.assertAllClose(
         initial_momentum + expected_change, final_momentum, atol=momentum_atol)
 
+  def test_dynamic_time_step(self):
+    grid = grids.Grid((32, 32), domain=((0, 1), (0, 1)))
+    v_initial = sinusoidal_velocity_field(grid)
+    dt = equations.dynamic_time_step(v_initial, 0.5, 1e-3, grid)
+    navier_stokes = equations.semi_implicit_navier_stokes(
+        density=1., viscosity=1e-3, dt=dt, grid=grid)
+    v_final = navier_stokes(v_initial)
+    divergence = fd.divergence(v_final)
+    self.assertLess(jnp.max(divergence.data), 1e-3)
+
 
 class ImplicitDiffusionNavierStokesTest(test_util.TestCase):
 
@@ -247,5 +258,36 @@ class ImplicitDiffusionNavierStokesTest(test_util.TestCase):
         initial_momentum + expected_change, final_momentum, atol=momentum_atol)
 
 
+class DynamicTimeStepTest(test_util.TestCase):
+
+  def test_matches_stable_time_step(self):
+    grid = grids.Grid((32, 32), domain=((0, 1), (0, 1)))
+    v = sinusoidal_velocity_field(grid)
+    dt = equations.dynamic_time_step(v, 0.5, 1e-3, grid)
+    max_velocity = jnp.sqrt(jnp.max(sum(u.data ** 2 for u in v)))
+    expected = equations.stable_time_step(max_velocity, 0.5, 1e-3, grid)
+    self.assertAllClose(dt, expected, rtol=1e-6)
+
+  def test_array_arguments(self):
+    grid = grids.Grid((32, 32), domain=((0, 1), (0, 1)))
+    expected = equations.stable_time_step(1.0, 0.5, 1e-3, grid)
+    actual = equations.stable_time_step(1.0, 0.5, jnp.array(1e-3), grid)
+    self.assertAllClose(actual, expected)
+    viscosities = jnp.array([1e-3, 2e-3])
+    actual = jax.vmap(
+        lambda nu: equations.stable_time_step(1.0, 0.5, nu, grid, True))(
+            viscosities)
+    self.assertAllClose(actual, jnp.full((2,), expected))
+
+  def test_zero_velocity(self):
+    grid = grids.Grid((32, 32), domain=((0, 1), (0, 1)))
+    v = zero_velocity_field(grid)
+    dt = equations.dynamic_time_step(v, 0.5, 1e-3, grid)
+    self.assertEqual(dt, diffusion.stable_time_step(1e-3, grid))
+    dt = equations.dynamic_time_step(
+        v, 0.5, 1e-3, grid, implicit_diffusion=True)
+    self.assertTrue(np.isfinite(dt))
+
+
 if __name__ == '__main__':
   absltest.main()
@@ -13,9 +13,12 @@
 # limitations under the License.
 
 """Examples of defining equations."""
-from typing import Callable, Optional
+import functools
+import operator
+from typing import Any, Callable, Optional, Sequence
 
 import jax
+import jax.numpy as jnp
 
 from jax_cfd.base import advection as base_advection
 from jax_cfd.base import grids
@@ -35,7 +38,40 @@ ForcingFn = Callable[[GridVariableVector], GridArrayVector]
 
 
 def sum_fields(*args):
-  return jax.tree.map(lambda *a: sum(a), *args)
+  return jax.tree.map(lambda *a: functools.reduce(operator.add, a), *args)
+
+
+def _default_convect(dt: float) -> ConvectFn:
+  """Returns Van-Leer convection of velocity with time step `dt`."""
+  def convect(v):
+    return tuple(
+        base_advection.advect_van_leer_using_limiters(u, v, dt) for u in v)
+  return convect
+
+
+_pressure_projection = jax.named_call(pressure.projection, name='pressure')
+
+
+def _stack(v):
+  """Stacks the data of the components of `v` along a new leading axis."""
+  return jnp.stack([u.data for u in v])
+
+
+def _unstack(data, v: GridVariableVector) -> GridVariableVector:
+  """Unstacks `data` into GridVariables aligned with the components of `v`."""
+  return tuple(
+      grids.GridVariable(grids.GridArray(d, u.offset, u.grid), u.bc)
+      for d, u in zip(data, v))
+
+
+def _diffuse_stacked(diffuse: DiffuseFn, v: GridVariableVector, nu: float):
+  """Returns stacked diffusion of `v`, evaluated in one batch if possible."""
+  if len({u.offset for u in v}) != 1 or len({u.bc for u in v}) != 1:
+    return _stack(tuple(diffuse(u, nu) for u in v))
+  u = v[0]
+  stacked = grids.GridVariable(
+      grids.GridArray(_stack(v), u.offset, u.grid), u.bc)
+  return jax.vmap(diffuse, in_axes=(0, None))(stacked, nu).data
 
 
 def semi_implicit_navier_stokes(
@@ -47,39 +83,70 @@ def semi_implicit_navier_stokes(
     diffuse: DiffuseFn = diffusion.diffuse,
     pressure_solve: Callable = pressure.solve_cg,
     forcing: Optional[ForcingFn] = None,
+    acceleration_dtype: Optional[Any] = None,
+    mesh: Optional[jax.sharding.Mesh] = None,
+    spatial_axes: Optional[Sequence[str]] = None,
+    donate: bool = True,
 ) -> Callable[[GridVariableVector], GridVariableVector]:
-  """Returns a function that performs a time step of Navier Stokes."""
+  """Returns a jitted function that performs a time step of Navier Stokes.
+
+  If `donate` is true (the default), the buffers of the input velocity are
+  donated to the step, so that XLA can reuse them for the output. When the step
+  is called outside of `jit`, the input velocity is consumed and must not be
+  used afterwards, and its components must not share a buffer (e.g. `(w, w)`).
+  Set `donate=False` to keep the input velocity valid.
+
+  If `acceleration_dtype` is given (e.g. `jnp.bfloat16`), convection, diffusion
+  and forcing are evaluated on a copy of the velocity cast to that dtype, which
+  reduces memory traffic for these bandwidth-bound terms. The time step is still
+  accumulated, and the pressure projection solved, in the dtype of the velocity.
+
+  If a device `mesh` (with `Auto` axis types) is given, the velocity components
+  are sharded along their leading spatial dimensions over the mesh axes named by
+  `spatial_axes` (all mesh axes by default), and XLA partitions the step with
+  the halo exchanges required by the stencils and the pressure solve.
+  """
   del grid  # unused
 
   if convect is None:
-    def convect(v):  # pylint: disable=function-redefined
-      return tuple(
-          base_advection.advect_van_leer_using_limiters(u, v, dt) for u in v)
+    convect = _default_convect(dt)
 
   convect = jax.named_call(convect, name='convection')
   diffuse = jax.named_call(diffuse, name='diffusion')
-  pressure_projection = jax.named_call(
-      pressure.projection, name='pressure')
+
+  # Resolve which explicit terms are present once, here, so that the step only
+  # contains the operations it needs. Each term is paired with the factor that
+  # converts its stacked acceleration into a velocity increment.
+  explicit_terms = [(dt, lambda v: _stack(convect(v)))]
+  if viscosity is not None:
+    nu = viscosity / density
+    explicit_terms.append((dt, lambda v: _diffuse_stacked(diffuse, v, nu)))
+  if forcing is not None:
+    # TODO(shoyer): include time in state?
+    explicit_terms.append((dt / density, lambda v: _stack(forcing(v))))
 
   @jax.named_call
   def navier_stokes_step(v: GridVariableVector) -> GridVariableVector:
     """Computes state at time `t + dt` using first order time integration."""
-    # Collect the acceleration terms
-    convection = convect(v)
-    accelerations = [convection]
-    if viscosity is not None:
-      diffusion_ = tuple(diffuse(u, viscosity / density) for u in v)
-      accelerations.append(diffusion_)
-    if forcing is not None:
-      # TODO(shoyer): include time in state?
-      force = forcing(v)
-      accelerations.append(tuple(f / density for f in force))
-    dvdt = sum_fields(*accelerations)
-    # Update v by taking a time step
-    v = tuple(
-        grids.GridVariable(u.array + dudt * dt, u.bc)
-        for u, dudt in zip(v, dvdt))
+    # Accumulate the time step directly into the stacked velocity components,
+    # so that each term is added by a single fused array expression.
+    v_data = _stack(v)
+    if acceleration_dtype is None:
+      v_explicit = v
+    else:
+      v_explicit = _unstack(v_data.astype(acceleration_dtype), v)
+    for scale, term in explicit_terms:
+      v_data += scale * term(v_explicit).astype(v_data.dtype)
+    v = _unstack(v_data, v)
     # Pressure projection to incompressible velocity field
-    v = pressure_projection(v, pressure_solve)
+    v = _pressure_projection(v, pressure_solve)
     return v
-  return navier_stokes_step
+  donate_argnums = 0 if donate else ()
+  if mesh is None:
+    return jax.jit(navier_stokes_step, donate_argnums=donate_argnums)
+  if spatial_axes is None:
+    spatial_axes = mesh.axis_names
+  sharding = jax.sharding.NamedSharding(
+      mesh, jax.sharding.PartitionSpec(*spatial_axes))
+  return jax.jit(navier_stokes_step, in_shardings=sharding,
+                 out_shardings=sharding, donate_argnums=donate_argnums)
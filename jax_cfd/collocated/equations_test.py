@@ -16,6 +16,7 @@
 
 from absl.testing import absltest
 from absl.testing import parameterized
+import jax
 import jax.numpy as jnp
 from jax_cfd.base import boundaries
 from jax_cfd.base import finite_differences as fd
@@ -143,6 +144,54 @@ class SemiImplicitNavierStokesTest(test_util.TestCase):
     self.assertAllClose(
         initial_momentum + expected_change, final_momentum, atol=momentum_atol)
 
+  def test_bfloat16_accelerations(self):
+    grid = grids.Grid((32, 32), step=(1., 1.))
+    v_initial = sinusoidal_velocity_field(grid)
+    kwargs = dict(density=1., viscosity=1e-2, dt=1e-2, grid=grid,
+                  pressure_solve=pressure.solve_cg, forcing=gaussian_forcing)
+
+    navier_stokes = equations.semi_implicit_navier_stokes(**kwargs)
+    navier_stokes_bf16 = equations.semi_implicit_navier_stokes(
+        acceleration_dtype=jnp.bfloat16, **kwargs)
+
+    v_final = funcutils.repeated(navier_stokes, 10)(v_initial)
+    v_final_bf16 = funcutils.repeated(navier_stokes_bf16, 10)(v_initial)
+    for u, u_bf16 in zip(v_final, v_final_bf16):
+      self.assertEqual(u_bf16.dtype, jnp.float32)
+      self.assertAllClose(u.data, u_bf16.data, atol=2e-3)
+
+  def test_sharded_step(self):
+    grid = grids.Grid((32, 32), step=(1., 1.))
+    kwargs = dict(density=1., viscosity=1e-2, dt=1e-2, grid=grid,
+                  pressure_solve=pressure.solve_cg)
+    num_devices = jax.device_count()
+    mesh = jax.make_mesh(
+        (num_devices, 1), ('x', 'y'),
+        axis_types=(jax.sharding.AxisType.Auto,) * 2)
+
+    navier_stokes = equations.semi_implicit_navier_stokes(**kwargs)
+    navier_stokes_sharded = equations.semi_implicit_navier_stokes(
+        mesh=mesh, **kwargs)
+
+    v_final = navier_stokes(sinusoidal_velocity_field(grid))
+    v_final_sharded = navier_stokes_sharded(sinusoidal_velocity_field(grid))
+    for u, u_sharded in zip(v_final, v_final_sharded):
+      self.assertEqual(u_sharded.data.sharding.spec,
+                       jax.sharding.PartitionSpec('x', 'y'))
+      self.assertAllClose(u.data, u_sharded.data, atol=1e-6)
+
+  def test_without_donation(self):
+    grid = grids.Grid((32, 32), step=(1., 1.))
+    navier_stokes = equations.semi_implicit_navier_stokes(
+        density=1., viscosity=1e-2, dt=1e-2, grid=grid, donate=False)
+    u, _ = sinusoidal_velocity_field(grid)
+    # components sharing a buffer, and reusing the inputs after the step.
+    v_initial = (u, u)
+    v_final = navier_stokes(v_initial)
+    v_again = navier_stokes(v_initial)
+    for u_final, u_again in zip(v_final, v_again):
+      self.assertAllClose(u_final.data, u_again.data)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -3,6 +3,9 @@ import functools
 
 from typing import Callable, Optional
 import gin
+import haiku as hk
+from jax import tree_util
+import jax.numpy as jnp
 from jax_cfd.base import advection
 from jax_cfd.base import grids
 from jax_cfd.ml import interpolations
@@ -20,6 +23,44 @@ ConvectFn = Callable[[GridVariableVector], GridArrayVector]
 ConvectionModule = Callable[..., ConvectFn]
 
 
+def _advect_general(
+    u_interpolate_fn: interpolations.InterpolationFn,
+    c_interpolate_fn: interpolations.InterpolationFn,
+    c: GridVariable,
+    v: GridVariableVector,
+    dt: Optional[float] = None
+) -> GridArray:
+  return advection.advect_general(c, v, u_interpolate_fn, c_interpolate_fn, dt)
+
+
+def _stack_field(v: GridVariableVector) -> Optional[GridVariable]:
+  """Stacks the components of `v` if they can share a single batched trace.
+
+  Args:
+    v: velocity field.
+
+  Returns:
+    A GridVariable whose data has the components of `v` along a new leading
+    axis, or `None` if the components differ in offset, grid or boundary
+    conditions (e.g. on a staggered grid), since those change the computation.
+  """
+  if (len({u.offset for u in v}) != 1 or len({u.grid for u in v}) != 1 or
+      len({u.bc for u in v}) != 1):
+    return None
+  u = v[0]
+  data = jnp.stack([u.data for u in v])
+  return GridVariable(GridArray(data, u.offset, u.grid), u.bc)
+
+
+def _inside_transform() -> bool:
+  """Returns whether this is called as part of an `hk.transform`."""
+  try:
+    hk.running_init()
+  except ValueError:
+    return False
+  return True
+
+
 @gin.register
 def modular_advection(
     grid: grids.Grid,
@@ -32,16 +73,7 @@ def modular_advection(
   """Modular advection module based on `advection_diffusion.advect_general`."""
   c_interpolate_fn = c_interpolation_module(grid, dt, physics_specs, **kwargs)
   u_interpolate_fn = u_interpolation_module(grid, dt, physics_specs, **kwargs)
-
-  def advect(
-      c: GridVariable,
-      v: GridVariableVector,
-      dt: Optional[float] = None
-  ) -> GridArray:
-    return advection.advect_general(
-        c, v, u_interpolate_fn, c_interpolate_fn, dt)
-
-  return advect
+  return tree_util.Partial(_advect_general, u_interpolate_fn, c_interpolate_fn)
 
 
 @gin.register
@@ -58,16 +90,7 @@ def modular_self_advection(
   interpolate_fn = interpolation_module(grid, dt, physics_specs, **kwargs)
   c_interpolate_fn = functools.partial(interpolate_fn, tag='c')
   u_interpolate_fn = functools.partial(interpolate_fn, tag='u')
-
-  def advect(
-      c: GridVariable,
-      v: GridVariableVector,
-      dt: Optional[float] = None
-  ) -> GridArray:
-    return advection.advect_general(
-        c, v, u_interpolate_fn, c_interpolate_fn, dt)
-
-  return advect
+  return tree_util.Partial(_advect_general, u_interpolate_fn, c_interpolate_fn)
 
 
 @gin.register
@@ -82,6 +105,14 @@ def self_advection(
   advect_fn = advection_module(grid, dt, physics_specs, **kwargs)
 
   def convect(v: GridVariableVector) -> GridArrayVector:
-    return tuple(advect_fn(u, v, dt) for u in v)
+    # `hk.vmap` is only valid inside a transform; `advect_fn` may create
+    # parameters, so outside of one we advect the components one at a time.
+    stacked = _stack_field(v) if _inside_transform() else None
+    if stacked is None:
+      return tuple(advect_fn(u, v, dt) for u in v)
+    advected = hk.vmap(lambda c: advect_fn(c, v, dt), split_rng=False)(stacked)
+    return tuple(
+        GridArray(data, advected.offset, advected.grid)
+        for data in advected.data)
 
   return convect
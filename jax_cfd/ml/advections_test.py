@@ -0,0 +1,47 @@
+"""Tests for jax_cfd.ml.advections."""
+
+from absl.testing import absltest
+import haiku as hk
+import jax.numpy as jnp
+from jax_cfd.base import boundaries
+from jax_cfd.base import grids
+from jax_cfd.base import test_util
+from jax_cfd.ml import advections
+from jax_cfd.ml import interpolations
+from jax_cfd.ml import physics_specifications
+import numpy as np
+
+
+class SelfAdvectionTest(test_util.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.grid = grids.Grid((16, 16), domain=((0, 2 * jnp.pi),) * 2)
+    self.physics_specs = physics_specifications.NavierStokesPhysicsSpecs(
+        forcing_module=None, density=1., viscosity=0.1)
+    bc = boundaries.periodic_boundary_conditions(2)
+    offset = (0.5, 0.5)
+    x, y = self.grid.mesh(offset)
+    self.v = tuple(
+        grids.GridVariable(grids.GridArray(data, offset, self.grid), bc)
+        for data in (jnp.sin(x) * jnp.cos(y), -jnp.cos(x) * jnp.sin(y)))
+
+  def _convect(self, v):
+    convect = advections.self_advection(
+        self.grid, 0.01, self.physics_specs,
+        advection_module=advections.modular_advection,
+        c_interpolation_module=interpolations.linear,
+        u_interpolation_module=interpolations.linear)
+    return convect(v)
+
+  def test_collocated_outside_transform(self):
+    actual = self._convect(self.v)
+    convect = hk.without_apply_rng(hk.transform(self._convect))
+    expected = convect.apply(convect.init(None, self.v), self.v)
+    for a, e in zip(actual, expected):
+      self.assertEqual(a.offset, e.offset)
+      np.testing.assert_allclose(a.data, e.data, atol=1e-6)
+
+
+if __name__ == '__main__':
+  absltest.main()
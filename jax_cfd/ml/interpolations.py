@@ -55,6 +55,8 @@ class FusedLearnedInterpolation:
       fuse_constraints=False,
       fuse_patches=False,
       constrain_with_conv=False,
+      sparse_constraints=False,
+      rematerialize_patches=False,
       tile_layout=None,
   ):
     """Constructs object and performs necessary pre-computate."""
@@ -89,7 +91,9 @@ class FusedLearnedInterpolation:
     if fuse_constraints:
       self._interpolators = layers.fuse_spatial_derivative_layers(
           derivatives, all_logits, fuse_patches=fuse_patches,
-          constrain_with_conv=constrain_with_conv)
+          constrain_with_conv=constrain_with_conv,
+          sparse_constraints=sparse_constraints,
+          rematerialize_patches=rematerialize_patches)
     else:
       split_logits = jnp.split(all_logits, np.cumsum(output_sizes), axis=-1)
       self._interpolators = {
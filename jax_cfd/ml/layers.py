@@ -8,6 +8,7 @@ from typing import (
 import haiku as hk
 import jax
 from jax import lax
+from jax.experimental import sparse
 import jax.numpy as jnp
 from jax_cfd.base import array_utils
 from jax_cfd.base import boundaries
@@ -21,34 +22,101 @@ Array = Union[np.ndarray, jax.Array]
 IntOrSequence = Union[int, Sequence[int]]
 
 
+def _conv_dimension_numbers(ndim: int) -> lax.ConvDimensionNumbers:
+  """Returns dimension numbers for channels-last inputs and kernels."""
+  spatial = tuple(range(1, ndim + 1))
+  return lax.ConvDimensionNumbers(
+      lhs_spec=(0, ndim + 1) + spatial,
+      rhs_spec=(ndim + 1, ndim) + tuple(range(ndim)),
+      out_spec=(0, ndim + 1) + spatial)
+
+
+def _kernel_initializer(
+    w_init: Optional[hk.initializers.Initializer],
+    fan_in_shape: Tuple[int, ...],
+) -> hk.initializers.Initializer:
+  """Returns `w_init`, defaulting to the initializer of `hk.ConvND`."""
+  if w_init is not None:
+    return w_init
+  stddev = 1. / np.sqrt(np.prod(fan_in_shape))
+  return hk.initializers.TruncatedNormal(stddev=stddev)
+
+
+class _ConvParameters(hk.Module):
+  """Kernel and bias of a convolution, scoped like those of `hk.ConvND`."""
+
+  def __init__(
+      self,
+      output_channels: int,
+      with_bias: bool = True,
+      w_init: Optional[hk.initializers.Initializer] = None,
+      b_init: Optional[hk.initializers.Initializer] = None,
+      name: Optional[str] = None,
+  ):
+    super().__init__(name=name)
+    self._output_channels = output_channels
+    self._with_bias = with_bias
+    self._w_init = w_init
+    self._b_init = b_init or jnp.zeros
+
+  def __call__(
+      self,
+      w_shape: Tuple[int, ...],
+      fan_in_shape: Tuple[int, ...],
+      dtype: Any,
+  ) -> Tuple[Array, Optional[Array]]:
+    """Returns the kernel `w` and the bias `b`, or `None` without a bias."""
+    w_init = _kernel_initializer(self._w_init, fan_in_shape)
+    w = hk.get_parameter('w', w_shape, dtype, init=w_init)
+    if not self._with_bias:
+      return w, None
+    b = hk.get_parameter(
+        'b', (self._output_channels,), dtype, init=self._b_init)
+    return w, b
+
+
 class PeriodicConvGeneral(hk.Module):
   """General periodic convolution module."""
 
   def __init__(
       self,
-      base_convolution: Callable[..., Any],
       output_channels: int,
       kernel_shape: Tuple[int, ...],
       rate: int = 1,
       tile_layout: Optional[Tuple[int, ...]] = None,
       name: str = 'periodic_conv_general',
-      **conv_kwargs: Any
+      fft_kernel_threshold: Optional[int] = None,
+      stride: int = 1,
+      with_bias: bool = True,
+      w_init: Optional[hk.initializers.Initializer] = None,
+      b_init: Optional[hk.initializers.Initializer] = None,
+      precision: Optional[lax.Precision] = None,
   ):
     """Constructs PeriodicConvGeneral module.
 
-    We use `VALID` padding on `base_convolution` and explicit padding to achieve
-    the effect of periodic boundary conditions. This function computes
-    `paddings` and combines `jnp.pad` function calls with `base_convolution`
-    module to produce the dersired effect.
+    We use a `VALID` convolution and explicit padding to achieve the effect of
+    periodic boundary conditions. This function computes `paddings` that are
+    applied to the inputs before calling `lax.conv_general_dilated`. The kernel
+    `w` and bias `b` have the same shapes, default initializers and parameter
+    paths (`<name>/~/conv{ndim}_d`) as if this module wrapped `hk.ConvND`.
+
+    For large kernels it is cheaper to evaluate the periodic convolution as a
+    pointwise product in Fourier space, which avoids the padding entirely. This
+    is enabled by setting `fft_kernel_threshold`.
 
     Args:
-      base_convolution: standard convolution module e.g. hk.Conv1D.
       output_channels: number of output channels.
-      kernel_shape: shape of the kernel, compatible with `base_convolution`.
+      kernel_shape: shape of the kernel.
       rate: dilation rate of the convolution.
       tile_layout: optional layout for tiling spatial dimensions in a batch.
       name: name of the module.
-      **conv_kwargs: additional arguments passed to `base_convolution`.
+      fft_kernel_threshold: if given, convolutions with a kernel size of at
+        least this value along some axis are computed with FFTs.
+      stride: stride of the convolution along every spatial axis.
+      with_bias: whether to add a bias to the outputs.
+      w_init: optional initializer for the kernel.
+      b_init: optional initializer for the bias, zeros by default.
+      precision: precision of the convolution, as in `hk.ConvND`.
     """
     super().__init__(name=name)
     self._padding = []
@@ -56,14 +124,66 @@ class PeriodicConvGeneral(hk.Module):
       effective_kernel = kernel_size + (rate - 1) * (kernel_size - 1)
       pad_left = effective_kernel // 2
       self._padding.append((pad_left, effective_kernel - pad_left - 1))
+    self._output_channels = output_channels
+    self._kernel_shape = tuple(kernel_shape)
+    self._rate = rate
+    self._stride = stride
     self._tile_layout = tile_layout
-    self._conv_module = base_convolution(
-        output_channels=output_channels, kernel_shape=kernel_shape,
-        padding='VALID', rate=rate, **conv_kwargs)
+    self._precision = precision
+    self._params = _ConvParameters(
+        output_channels, with_bias=with_bias, w_init=w_init, b_init=b_init,
+        name=f'conv{len(self._kernel_shape)}_d')
+    self._use_fft = (fft_kernel_threshold is not None and
+                     max(kernel_shape) >= fft_kernel_threshold)
+    if self._use_fft and tile_layout is not None:
+      raise ValueError('tile_layout is not supported for FFT convolutions')
+
+  def _get_params(self, inputs: Array) -> Tuple[Array, Optional[Array]]:
+    w_shape = self._kernel_shape + (inputs.shape[-1], self._output_channels)
+    return self._params(w_shape, w_shape[:-1], inputs.dtype)
+
+  def _fft_convolution(self, inputs):
+    """Applies the periodic convolution as a product in Fourier space."""
+    ndim = len(self._kernel_shape)
+    spatial_axes = tuple(range(ndim))
+    spatial_shape = inputs.shape[:ndim]
+    w, b = self._get_params(inputs)
+
+    # Embed the dilated kernel in the periodic domain, shifted such that output
+    # `i` combines the same inputs as the `VALID` convolution of padded inputs.
+    for size, (pad_left, pad_right) in zip(spatial_shape, self._padding):
+      if pad_left + pad_right >= size:
+        raise ValueError(f'kernel is too large for inputs {inputs.shape}')
+    kernel = jnp.zeros(spatial_shape + w.shape[-2:], inputs.dtype)
+    kernel = kernel.at[tuple(slice(None, pad_left + pad_right + 1, self._rate)
+                             for pad_left, pad_right in self._padding)].set(w)
+    kernel = jnp.roll(kernel, [-pad_left for pad_left, _ in self._padding],
+                      spatial_axes)
+
+    inputs_hat = jnp.fft.rfftn(inputs, axes=spatial_axes)
+    kernel_hat = jnp.conj(jnp.fft.rfftn(kernel, axes=spatial_axes))
+    outputs_hat = jnp.einsum('...i,...io->...o', inputs_hat, kernel_hat)
+    outputs = jnp.fft.irfftn(outputs_hat, s=spatial_shape, axes=spatial_axes)
+    outputs = outputs[(slice(None, None, self._stride),) * ndim]
+    outputs = outputs.astype(inputs.dtype)
+    return outputs if b is None else outputs + b
 
   def __call__(self, inputs):
+    if self._use_fft:
+      return self._fft_convolution(inputs)
+    ndim = len(self._kernel_shape)
+    w, b = self._get_params(inputs)
+    dimension_numbers = _conv_dimension_numbers(ndim)
+
+    def conv(padded):
+      outputs = lax.conv_general_dilated(
+          padded, w, window_strides=(self._stride,) * ndim, padding='VALID',
+          rhs_dilation=(self._rate,) * ndim,
+          dimension_numbers=dimension_numbers, precision=self._precision)
+      return outputs if b is None else outputs + b
+
     return tiling.apply_convolution(
-        self._conv_module, inputs, self._tile_layout, self._padding)
+        conv, inputs, self._tile_layout, self._padding)
 
 
 class PeriodicConv1D(PeriodicConvGeneral):
@@ -80,7 +200,6 @@ class PeriodicConv1D(PeriodicConvGeneral):
   ):
     """Constructs PeriodicConv1D module."""
     super().__init__(
-        base_convolution=hk.Conv1D,
         output_channels=output_channels,
         kernel_shape=kernel_shape,
         rate=rate,
@@ -104,7 +223,6 @@ class PeriodicConv2D(PeriodicConvGeneral):
   ):
     """Constructs PeriodicConv2D module."""
     super().__init__(
-        base_convolution=hk.Conv2D,
         output_channels=output_channels,
         kernel_shape=kernel_shape,
         rate=rate,
@@ -128,7 +246,6 @@ class PeriodicConv3D(PeriodicConvGeneral):
   ):
     """Constructs PeriodicConv3D module."""
     super().__init__(
-        base_convolution=hk.Conv3D,
         output_channels=output_channels,
         kernel_shape=kernel_shape,
         rate=rate,
@@ -165,26 +282,36 @@ class MirrorConvGeneral(hk.Module):
       **conv_kwargs: additional arguments passed to `base_convolution`.
     """
     super().__init__(name=name)
-    self._padding = np.zeros(2).astype('int')
-    for kernel_size in kernel_shape:
-      effective_kernel = kernel_size + (rate - 1) * (kernel_size - 1)
-      pad_left = effective_kernel // 2
-      self._padding += np.array([pad_left,
-                                 effective_kernel - pad_left - 1]).astype('int')
+    kernel_sizes = np.array(kernel_shape)
+    effective_kernel = kernel_sizes + (rate - 1) * (kernel_sizes - 1)
+    pad_left = effective_kernel // 2
+    self._padding = tuple(
+        (int(left), int(right))
+        for left, right in zip(pad_left, effective_kernel - pad_left - 1))
     self._tile_layout = tile_layout
     self._conv_module = base_convolution(
         output_channels=output_channels, kernel_shape=kernel_shape,
         padding='VALID', rate=rate, **conv_kwargs)
 
-  def _expand_var(self, var):
-    var = var.bc.pad_all(
-        var, (self._padding,) * var.grid.ndim, mode=boundaries.Padding.MIRROR)
-    return jnp.expand_dims(var.data, axis=-1)
+  def _pad_var(self, var):
+    var = var.bc.pad_all(var, self._padding, mode=boundaries.Padding.MIRROR)
+    return var.data
 
   def __call__(self, inputs):
-    input_data = tuple(self._expand_var(var) for var in inputs)
-    input_data = array_utils.concat_along_axis(
-        jax.tree.leaves(input_data), axis=-1)
+    if len({var.offset for var in inputs}) == 1 and len(
+        {var.bc for var in inputs}) == 1:
+      # pad all inputs at once, stacked along the channel axis of the outputs.
+      var = inputs[0]
+      stacked = grids.GridVariable(
+          grids.GridArray(
+              jnp.stack([var.data for var in inputs]), var.offset, var.grid),
+          var.bc)
+      input_data = jax.vmap(self._pad_var, out_axes=-1)(stacked)
+    else:
+      input_data = tuple(
+          jnp.expand_dims(self._pad_var(var), axis=-1) for var in inputs)
+      input_data = array_utils.concat_along_axis(
+          jax.tree.leaves(input_data), axis=-1)
     outputs = self._conv_module(input_data)
     outputs = array_utils.split_axis(outputs, -1)
     outputs = tuple(
@@ -215,6 +342,38 @@ class MirrorConv2D(MirrorConvGeneral):
         **conv_kwargs)
 
 
+@functools.partial(jax.jit, static_argnums=(1,))
+def _periodic_wrap_left(inputs: Array, pads: Tuple[int, ...]) -> Array:
+  """Periodically pads the start of each leading axis of `inputs` by `pads`."""
+  for axis, pad in enumerate(pads):
+    size = inputs.shape[axis]
+    # pads larger than the axis wrap around it more than once.
+    num_wraps, remainder = divmod(pad, size)
+    pieces = [lax.slice_in_dim(inputs, size - remainder, size, axis=axis)]
+    inputs = lax.concatenate(pieces + [inputs] * (num_wraps + 1), axis)
+  return inputs
+
+
+@functools.partial(jax.jit, static_argnums=(1, 2, 3))
+def _periodic_output_window(
+    output: Array,
+    starts: Tuple[int, ...],
+    roll_shifts: Tuple[int, ...],
+    sizes: Tuple[int, ...],
+) -> Array:
+  """Slices periodic windows of `output` and rolls them by `roll_shifts`."""
+  # Slicing out the periodic image and rolling it back into alignment is done
+  # with one pair of static slices per axis, rather than a slice and a roll.
+  for axis, (start, roll_shift, size) in enumerate(
+      zip(starts, roll_shifts, sizes)):
+    shift = -roll_shift % size
+    output = jnp.concatenate([
+        lax.slice_in_dim(output, start + shift, start + size, axis=axis),
+        lax.slice_in_dim(output, start, start + shift, axis=axis),
+    ], axis=axis)
+  return output
+
+
 class PeriodicConvTransposeGeneral(hk.Module):
   """General periodic transpose convolution module."""
 
@@ -226,6 +385,7 @@ class PeriodicConvTransposeGeneral(hk.Module):
       stride: int = 1,
       tile_layout: Optional[Tuple[int, ...]] = None,
       name: str = 'periodic_conv_transpose_general',
+      fft_kernel_threshold: Optional[int] = None,
       **conv_kwargs: Any
   ):
     """Constructs PeriodicConvTransposeGeneral module.
@@ -242,6 +402,11 @@ class PeriodicConvTransposeGeneral(hk.Module):
     as the spatial location of the output and hence shift it back by half of
     the kernel size.)
 
+    As for `PeriodicConvGeneral`, large kernels can instead be applied in
+    Fourier space, to the inputs upsampled with zeros by `stride`. The kernel
+    `w` and bias `b` then keep the parameter paths of `base_convolution`
+    (`<name>/~/conv{ndim}_d_transpose`).
+
     Args:
       base_convolution: standard transpose convolution module.
       output_channels: number of output channels.
@@ -249,6 +414,8 @@ class PeriodicConvTransposeGeneral(hk.Module):
       stride: stride to use in `base_convolution`.
       tile_layout: optional layout for tiling spatial dimensions in a batch.
       name: name of the module.
+      fft_kernel_threshold: if given, convolutions with a kernel size of at
+        least this value along some axis are computed with FFTs.
       **conv_kwargs: additional arguments passed to `base_convolution`.
     """
     if tile_layout is not None:
@@ -258,6 +425,7 @@ class PeriodicConvTransposeGeneral(hk.Module):
     self._stride = stride
     self._kernel_shape = kernel_shape
     self._padding = []
+    self._output_starts = []
     self._roll_shifts = []
     for kernel_size in kernel_shape:
       # left pad should be large enough so that contribution from the leftmost
@@ -266,12 +434,56 @@ class PeriodicConvTransposeGeneral(hk.Module):
       # kernel_size (last affected value of the input)
       pad_left = kernel_size // stride + 1
       self._padding.append((pad_left, 0))
+      self._output_starts.append(stride * pad_left)
       # we shift by half a kernel size at the end to recover spatial alignment.
       self._roll_shifts.append(-((kernel_size - 1) // 2))
     self._tile_layout = tile_layout
-    self._conv_module = base_convolution(
-        output_channels=output_channels, kernel_shape=kernel_shape,
-        stride=stride, padding='VALID', **conv_kwargs)
+    self._use_fft = (fft_kernel_threshold is not None and
+                     max(kernel_shape) >= fft_kernel_threshold)
+    if self._use_fft:
+      self._output_channels = output_channels
+      params_kwargs = {key: conv_kwargs.pop(key) for key in
+                       ('with_bias', 'w_init', 'b_init') if key in conv_kwargs}
+      if conv_kwargs:
+        raise ValueError(
+            f'unsupported arguments for FFT convolutions: {set(conv_kwargs)}')
+      self._params = _ConvParameters(
+          output_channels, name=f'conv{len(kernel_shape)}_d_transpose',
+          **params_kwargs)
+    else:
+      self._conv_module = base_convolution(
+          output_channels=output_channels, kernel_shape=kernel_shape,
+          stride=stride, padding='VALID', **conv_kwargs)
+
+  def _fft_convolution(self, inputs):
+    """Applies the periodic transpose convolution in Fourier space."""
+    ndim = len(self._kernel_shape)
+    spatial_axes = tuple(range(ndim))
+    output_shape = tuple(self._stride * size for size in inputs.shape[:ndim])
+    input_channels = inputs.shape[-1]
+    w_shape = tuple(self._kernel_shape) + (self._output_channels,
+                                           input_channels)
+    w, b = self._params(
+        w_shape, tuple(self._kernel_shape) + (input_channels,), inputs.dtype)
+
+    # input `i` contributes `flip(w)` to outputs centered at `stride * i`.
+    for kernel_size, size in zip(self._kernel_shape, output_shape):
+      if kernel_size > size:
+        raise ValueError(f'kernel is too large for inputs {inputs.shape}')
+    kernel = jnp.zeros(output_shape + w_shape[-2:], inputs.dtype)
+    kernel = kernel.at[tuple(slice(None, k) for k in self._kernel_shape)].set(
+        jnp.flip(w, spatial_axes))
+    kernel = jnp.roll(kernel, self._roll_shifts, spatial_axes)
+    upsampled = jnp.zeros(output_shape + (input_channels,), inputs.dtype)
+    upsampled = upsampled.at[
+        (slice(None, None, self._stride),) * ndim].set(inputs)
+
+    upsampled_hat = jnp.fft.rfftn(upsampled, axes=spatial_axes)
+    kernel_hat = jnp.fft.rfftn(kernel, axes=spatial_axes)
+    outputs_hat = jnp.einsum('...i,...oi->...o', upsampled_hat, kernel_hat)
+    outputs = jnp.fft.irfftn(outputs_hat, s=output_shape, axes=spatial_axes)
+    outputs = outputs.astype(inputs.dtype)
+    return outputs if b is None else outputs + b
 
   def __call__(self, inputs):
     """Applies PeriodicTransposeConvolution to `inputs`.
@@ -283,18 +495,15 @@ class PeriodicConvTransposeGeneral(hk.Module):
     Returns:
       `inputs` convolved with the kernel of the module with periodic padding.
     """
-    ndim = len(self._kernel_shape)
-    output_slice = []
-    for axis, (left_pad, _) in enumerate(self._padding[:ndim]):
-      axis_size = inputs.shape[axis]
-      output_start = self._stride * left_pad
-      output_end = self._stride * (axis_size + left_pad)
-      output_slice.append(slice(output_start, output_end))
-    output_slice.append(slice(None, None))
-    output = tiling.apply_convolution(
-        self._conv_module, inputs, self._tile_layout, self._padding)
-    sliced_output = output[tuple(output_slice)]
-    return jnp.roll(sliced_output, self._roll_shifts, list(range(ndim)))
+    if self._use_fft:
+      return self._fft_convolution(inputs)
+    padded = _periodic_wrap_left(
+        inputs, tuple(pad_left for pad_left, _ in self._padding))
+    output = jnp.squeeze(
+        self._conv_module(jnp.expand_dims(padded, axis=0)), axis=0)
+    sizes = tuple(self._stride * size for size in inputs.shape[:-1])
+    return _periodic_output_window(
+        output, tuple(self._output_starts), tuple(self._roll_shifts), sizes)
 
 
 class PeriodicConvTranspose1D(PeriodicConvTransposeGeneral):
@@ -369,6 +578,36 @@ class PeriodicConvTranspose3D(PeriodicConvTransposeGeneral):
     )
 
 
+@functools.partial(jax.custom_jvp, nondiff_argnums=(1,))
+def _min_and_max(inputs: Array, axes: Tuple[int, ...]) -> Tuple[Array, Array]:
+  """Returns the minimum and maximum of `inputs` from a single reduction."""
+  if jnp.issubdtype(inputs.dtype, jnp.inexact):
+    largest, smallest = jnp.inf, -jnp.inf
+  else:
+    info = jnp.iinfo(inputs.dtype)
+    largest, smallest = info.max, info.min
+  init_values = (jnp.array(largest, inputs.dtype),
+                 jnp.array(smallest, inputs.dtype))
+  return lax.reduce(
+      (inputs, inputs), init_values,
+      lambda x, y: (jnp.minimum(x[0], y[0]), jnp.maximum(x[1], y[1])), axes)
+
+
+@_min_and_max.defjvp
+def _min_and_max_jvp(axes, primals, tangents):
+  # like `jnp.min` and `jnp.max`, split tangents evenly between tied extrema.
+  inputs, = primals
+  inputs_dot, = tangents
+  extrema = _min_and_max(inputs, axes)
+
+  def extremum_tangent(extremum):
+    is_extremum = inputs == jnp.expand_dims(extremum, axes)
+    counts = jnp.sum(is_extremum, axes).astype(inputs_dot.dtype)
+    return jnp.sum(jnp.where(is_extremum, inputs_dot, 0), axes) / counts
+
+  return extrema, tuple(extremum_tangent(extremum) for extremum in extrema)
+
+
 def rescale_to_range(
     inputs: Array,
     min_value: float,
@@ -390,8 +629,11 @@ def rescale_to_range(
   Returns:
     `inputs` rescaled to [min_value, max_value] range.
   """
-  inputs_max = jnp.max(inputs, axis=axes, keepdims=True)
-  inputs_min = jnp.min(inputs, axis=axes, keepdims=True)
+  inputs = jnp.asarray(inputs)
+  axes = tuple(axis % inputs.ndim for axis in axes)
+  inputs_min, inputs_max = _min_and_max(inputs, axes)
+  inputs_min = jnp.expand_dims(inputs_min, axes)
+  inputs_max = jnp.expand_dims(inputs_max, axes)
   scale = (inputs_max - inputs_min) / (max_value - min_value)
   return (inputs - inputs_min) / scale + min_value
 
@@ -448,6 +690,87 @@ class NonPeriodicConv1D(NonPeriodicConvGeneral):
         **conv_kwargs)
 
 
+@functools.lru_cache(maxsize=None)
+def _polynomial_constraints(
+    stencils: Tuple[Tuple[float, ...], ...],
+    method: layers_util.Method,
+    derivative_orders: Tuple[int, ...],
+    accuracy_order: int,
+    grid_step: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """Returns polynomial accuracy constraints and a basis of their nullspace.
+
+  Models typically build many derivative layers with the same stencils, so the
+  constraints and the SVD of the constraint matrix are computed once for each
+  distinct set of arguments. The returned arrays are read-only.
+
+  Args:
+    stencils: 1d stencils, one per grid dimension.
+    method: discretization method (finite volumes or finite differences).
+    derivative_orders: derivative orders along corresponding directions.
+    accuracy_order: order to which polynomial accuracy is enforced.
+    grid_step: spatial separation between the adjacent cells.
+
+  Returns:
+    Tuple `(constraint_matrix, rhs, nullspace)`, where the rows of `nullspace`
+    form an orthonormal basis of the nullspace of `constraint_matrix`.
+  """
+  constraint_matrix, rhs = layers_util.polynomial_accuracy_constraints(
+      [np.array(stencil) for stencil in stencils], method, derivative_orders,
+      accuracy_order, grid_step)
+  # https://en.wikipedia.org/wiki/Kernel_(linear_algebra)#Nonhomogeneous_systems_of_linear_equations
+  _, _, v = np.linalg.svd(constraint_matrix)
+  nullspace_size = constraint_matrix.shape[1] - constraint_matrix.shape[0]
+  nullspace = v[v.shape[0] - nullspace_size:]
+  for array in (constraint_matrix, rhs, nullspace):
+    array.setflags(write=False)
+  return constraint_matrix, rhs, nullspace
+
+
+def _validate_bias(bias: np.ndarray, constraint_matrix: np.ndarray,
+                   rhs: np.ndarray):
+  norm = np.linalg.norm(np.dot(constraint_matrix, bias) - rhs)
+  if norm > 1e-8:
+    raise ValueError('invalid bias, not in nullspace')
+
+
+@functools.lru_cache(maxsize=None)
+def _default_bias(
+    stencils: Tuple[Tuple[float, ...], ...],
+    method: layers_util.Method,
+    derivative_orders: Tuple[int, ...],
+    accuracy_order: int,
+    bias_accuracy_order: int,
+    grid_step: float,
+) -> np.ndarray:
+  """Returns validated standard coefficients to use as a constraint bias.
+
+  Like `_polynomial_constraints`, this is computed and checked against the
+  constraints once for each distinct set of arguments. The returned array is
+  read-only.
+
+  Args:
+    stencils: 1d stencils, one per grid dimension.
+    method: discretization method (finite volumes or finite differences).
+    derivative_orders: derivative orders along corresponding directions.
+    accuracy_order: order to which polynomial accuracy is enforced.
+    bias_accuracy_order: order of polynomial accuracy of the bias.
+    grid_step: spatial separation between the adjacent cells.
+
+  Returns:
+    Flattened coefficients of the bias.
+  """
+  bias_grid = layers_util.polynomial_accuracy_coefficients(
+      [np.array(stencil) for stencil in stencils], method, derivative_orders,
+      bias_accuracy_order, grid_step)
+  bias = bias_grid.ravel()
+  constraint_matrix, rhs, _ = _polynomial_constraints(
+      stencils, method, derivative_orders, accuracy_order, grid_step)
+  _validate_bias(bias, constraint_matrix, rhs)
+  bias.setflags(write=False)
+  return bias
+
+
 class PolynomialConstraint():
   """Module that parametrizes coefficients of polynomially accurate derivatives.
 
@@ -468,7 +791,8 @@ class PolynomialConstraint():
       accuracy_order: int = 1,
       bias_accuracy_order: int = 1,
       bias: Optional[Array] = None,
-      precision: lax.Precision = lax.Precision.HIGHEST
+      precision: lax.Precision = lax.Precision.HIGHEST,
+      nullspace_dtype: Optional[Any] = None,
   ):
     """Constructs the object.
 
@@ -485,30 +809,31 @@ class PolynomialConstraint():
         default, we use standard low-order coefficients for the given grid.
       precision: numerical precision for matrix multplication. Only relevant on
         TPUs.
+      nullspace_dtype: optional lower precision dtype (e.g. `jnp.bfloat16`) in
+        which to store the nullspace and multiply it with the inputs. Products
+        are still accumulated in the dtype of the bias.
     """
     self.precision = precision
+    self.nullspace_dtype = nullspace_dtype
     grid_steps = {*steps}
     if len(grid_steps) != 1:
       raise ValueError('nonuniform steps not supported by PolynomialConstraint')
     grid_step, = grid_steps
     #  stencil coefficients `c` satisfying `constraint_matrix @ c = rhs`
     #  satisfies polynomial accuracy constraint of the given order
-    constraint_matrix, rhs = layers_util.polynomial_accuracy_constraints(
+    stencils = tuple(tuple(stencil) for stencil in stencils)
+    derivative_orders = tuple(derivative_orders)
+    constraint_matrix, rhs, nullspace = _polynomial_constraints(
         stencils, method, derivative_orders, accuracy_order, grid_step)
 
     if bias is None:
-      bias_grid = layers_util.polynomial_accuracy_coefficients(
-          stencils, method, derivative_orders, bias_accuracy_order, grid_step)
-      bias = bias_grid.ravel()
-
+      bias = _default_bias(stencils, method, derivative_orders, accuracy_order,
+                           bias_accuracy_order, grid_step)
+    else:
+      _validate_bias(bias, constraint_matrix, rhs)
     self.bias = bias
-    norm = np.linalg.norm(np.dot(constraint_matrix, bias) - rhs)
-    if norm > 1e-8:
-      raise ValueError('invalid bias, not in nullspace')
 
-    # https://en.wikipedia.org/wiki/Kernel_(linear_algebra)#Nonhomogeneous_systems_of_linear_equations
-    _, _, v = np.linalg.svd(constraint_matrix)
-    nullspace_size = constraint_matrix.shape[1] - constraint_matrix.shape[0]
+    nullspace_size = nullspace.shape[0]
     if not nullspace_size:
       raise ValueError(
           'there is only one valid solution accurate to this order')
@@ -516,8 +841,14 @@ class PolynomialConstraint():
     # nullspace from the SVD is always normalized such that its singular values
     # are 1 or 0, which means it's actually independent of the grid spacing.
     self._nullspace_size = nullspace_size
-    self.nullspace = v[-nullspace_size:]
-    self.nullspace /= (grid_step**np.array(derivative_orders)).prod()
+    self.nullspace = (
+        nullspace / (grid_step**np.array(derivative_orders)).prod())
+    # `bias` and `nullspace` are kept as NumPy arrays for host-side fusion of
+    # derivative layers, while `__call__` uses copies on the default device,
+    # which are converted and transferred once rather than on every call.
+    with jax.ensure_compile_time_eval():
+      self._device_bias = jnp.asarray(self.bias)
+      self._device_nullspace = jnp.asarray(self.nullspace, nullspace_dtype)
 
   @property
   def subspace_size(self) -> int:
@@ -540,8 +871,12 @@ class PolynomialConstraint():
       `derivate_orders` with polynomial accuracy on a stencil specified in
       `stencils` at position (0.,) * ndims.
     """
-    return self.bias + jnp.tensordot(inputs, self.nullspace, axes=[-1, 0],
-                                     precision=self.precision)
+    if self.nullspace_dtype is not None:
+      inputs = inputs.astype(self.nullspace_dtype)
+    return jnp.einsum(
+        '...i,ij->...j', inputs, self._device_nullspace,
+        precision=self.precision,
+        preferred_element_type=self._device_bias.dtype) + self._device_bias
 
 
 class StencilCoefficients():
@@ -601,13 +936,15 @@ class SpatialDerivativeFromLogits:
       extract_patch_method: str = 'roll',
       tile_layout: Optional[Tuple[int, ...]] = None,
       method: layers_util.Method = layers_util.Method.FINITE_VOLUME,
+      nullspace_dtype: Optional[Any] = None,
   ):
     self.stencil_shape = stencil_shape
     self.roll, shift = layers_util.get_roll_and_shift(
         input_offset, target_offset)
     stencils = layers_util.get_stencils(stencil_shape, shift, steps)
     self.constraint = PolynomialConstraint(
-        stencils, derivative_orders, method, steps)
+        stencils, derivative_orders, method, steps,
+        nullspace_dtype=nullspace_dtype)
     self._extract_patch_method = extract_patch_method
     self.tile_layout = tile_layout
 
@@ -625,11 +962,9 @@ class SpatialDerivativeFromLogits:
                        f'size; {logits.shape[-1]} vs. {self.subspace_size}')
 
   def extract_patches(self, inputs):
-    rolled = jnp.roll(inputs, self.roll)
-    patches = layers_util.extract_patches(
-        rolled, self.stencil_shape,
-        self._extract_patch_method, self.tile_layout)
-    return patches
+    return layers_util.extract_patches(
+        inputs, self.stencil_shape,
+        self._extract_patch_method, self.tile_layout, roll=self.roll)
 
   @functools.partial(jax.named_call, name='SpatialDerivativeFromLogits')
   def __call__(self, inputs, logits):
@@ -642,18 +977,69 @@ class SpatialDerivativeFromLogits:
 T = TypeVar('T')
 
 
+class _HashableConstraint:
+  """Wraps a PolynomialConstraint to compare by its bias and nullspace."""
+
+  def __init__(self, constraint: PolynomialConstraint):
+    self.constraint = constraint
+    self._key = (constraint.bias.tobytes(), constraint.nullspace.shape,
+                 constraint.nullspace.tobytes())
+
+  def __hash__(self):
+    return hash(self._key)
+
+  def __eq__(self, other):
+    return self._key == other._key  # pylint: disable=protected-access
+
+
+@functools.lru_cache(maxsize=None)
+def _joint_constraints(
+    constraints: Tuple[_HashableConstraint, ...],
+) -> Tuple[jax.Array, jax.Array]:
+  """Returns the joint bias and block diagonal nullspace of `constraints`.
+
+  Fused derivative layers are typically rebuilt with identical constraints on
+  every step, so the block diagonal matrix is only assembled and transferred to
+  the device once.
+
+  Args:
+    constraints: constraints of the derivatives to fuse.
+
+  Returns:
+    Tuple `(joint_bias, joint_nullspace)` of arrays on the default device.
+  """
+  joint_bias = np.concatenate([c.constraint.bias for c in constraints])
+  joint_nullspace = scipy.linalg.block_diag(
+      *[c.constraint.nullspace for c in constraints])
+  with jax.ensure_compile_time_eval():
+    return jnp.asarray(joint_bias), jnp.asarray(joint_nullspace)
+
+
+@functools.lru_cache(maxsize=None)
+def _sparse_joint_nullspace(
+    constraints: Tuple[_HashableConstraint, ...],
+) -> sparse.BCOO:
+  """Returns the block diagonal nullspace of `constraints` as a sparse array."""
+  _, joint_nullspace = _joint_constraints(constraints)
+  with jax.ensure_compile_time_eval():
+    return sparse.BCOO.fromdense(joint_nullspace)
+
+
 def fuse_spatial_derivative_layers(
     derivatives: Dict[T, SpatialDerivativeFromLogits],
     all_logits: jnp.ndarray,
     *,
     constrain_with_conv: bool = False,
     fuse_patches: bool = False,
+    sparse_constraints: bool = False,
+    rematerialize_patches: bool = False,
 ) -> Dict[T, Callable[[jnp.ndarray], jnp.ndarray]]:
   """Evaluate spatial derivatives by fusing together constraints.
 
   Despite the additional calculation, this can be faster on TPUs because the
   full block diagonal constraint matrix is small enough to fit within a 128x128
-  matrix.
+  matrix. For many derivatives the dense matrix is mostly zeros, in which case
+  `sparse_constraints` multiplies by its sparse representation instead.
 
   Args:
     derivatives: mapping from key to SpatialDerivativeFromLogits.
@@ -661,54 +1047,93 @@ def fuse_spatial_derivative_layers(
     constrain_with_conv: whether to constrain with a 1x1 convolution instead of
       direct matrix multiplication.
     fuse_patches: whether to also fuse the extraction of patches.
+    sparse_constraints: whether to store the block diagonal constraint matrix
+      in a sparse format. Not supported with `constrain_with_conv`.
+    rematerialize_patches: whether to recompute patches when differentiating
+      the derivatives, instead of keeping them in memory. Patches are larger
+      than their inputs by a factor of the stencil size.
 
   Returns:
     Functions that when applied evaluate derivatives.
   """
-  joint_bias = jnp.concatenate(
-      [derivative.constraint.bias for derivative in derivatives.values()])
-  joint_nullspace = scipy.linalg.block_diag(
-      *[deriv.constraint.nullspace for deriv in derivatives.values()]
-  )
+  if sparse_constraints and constrain_with_conv:
+    raise ValueError(
+        'sparse_constraints is not supported with constrain_with_conv')
+  constraints = tuple(
+      _HashableConstraint(deriv.constraint) for deriv in derivatives.values())
+  joint_bias, joint_nullspace = _joint_constraints(constraints)
   precision, = {deriv.constraint.precision for deriv in derivatives.values()}
+  nullspace_dtype, = {
+      deriv.constraint.nullspace_dtype for deriv in derivatives.values()}
   tile_layout, = {deriv.tile_layout for deriv in derivatives.values()}
 
   if constrain_with_conv:
     ndim = len(tile_layout)
+    kernel_dtype = jnp.float32 if nullspace_dtype is None else nullspace_dtype
     kernel = jnp.expand_dims(
-        joint_nullspace.astype(np.float32), axis=tuple(range(ndim)))
+        joint_nullspace.astype(kernel_dtype), axis=tuple(range(ndim)))
     all_coefficients = joint_bias + layers_util.periodic_convolution(
-        all_logits, kernel, tile_layout=tile_layout, precision=precision)
+        all_logits.astype(kernel_dtype), kernel, tile_layout=tile_layout,
+        precision=precision, preferred_element_type=joint_bias.dtype)
   else:
     if tile_layout is not None:
       all_logits = tiling.space_to_batch(all_logits, tile_layout)
-    all_coefficients = joint_bias + jnp.tensordot(
-        all_logits, joint_nullspace, axes=[-1, 0], precision=precision)
+    if sparse_constraints:
+      joint_nullspace = _sparse_joint_nullspace(constraints)
+      tensordot = sparse.sparsify(jnp.tensordot)
+    else:
+      tensordot = jnp.tensordot
+    if nullspace_dtype is not None:
+      all_logits = all_logits.astype(nullspace_dtype)
+      joint_nullspace = joint_nullspace.astype(nullspace_dtype)
+    all_coefficients = joint_bias + tensordot(
+        all_logits, joint_nullspace, axes=[-1, 0], precision=precision,
+        preferred_element_type=joint_bias.dtype)
     if tile_layout is not None:
       all_coefficients = tiling.batch_to_space(all_coefficients, tile_layout)
 
   stencil_sizes = [deriv.stencil_size for deriv in derivatives.values()]
-  coefficients_list = jnp.split(
-      all_coefficients, np.cumsum(stencil_sizes), axis=-1)
+  if len(set(stencil_sizes)) == 1:
+    # a single reshape, from which each derivative takes a static index.
+    stacked_coefficients = jnp.reshape(
+        all_coefficients,
+        all_coefficients.shape[:-1] + (len(stencil_sizes), stencil_sizes[0]))
+    coefficients_list = [
+        stacked_coefficients[..., i, :] for i in range(len(stencil_sizes))]
+  else:
+    coefficients_list = jnp.split(
+        all_coefficients, np.cumsum(stencil_sizes), axis=-1)
   coefficients_map = dict(zip(derivatives, coefficients_list))
 
   stencil_shapes = [deriv.stencil_shape for k, deriv in derivatives.items()]
   for k, deriv in derivatives.items():
     if any(r != 0 for r in deriv.roll):
       raise ValueError(f'derivative {k} uses roll: {deriv.roll}')
+  # static bounds of the terms of each derivative in the stacked patches.
+  stops = np.cumsum(stencil_sizes)
+  segments = {k: slice(stop - size, stop)
+              for k, size, stop in zip(derivatives, stencil_sizes, stops)}
 
-  @functools.partial(jax.named_call, name='evaluate_derivatives')
-  def evaluate(key, inputs):
+  def apply_to_patches(key, inputs, coefficients):
     if fuse_patches:
+      # Only the terms of `key` are weighted and summed; the extraction of all
+      # patches is identical for every key evaluated on the same `inputs`.
       all_patches = layers_util.fused_extract_patches(
           inputs, stencil_shapes, tile_layout)
-      all_terms = all_coefficients * all_patches
-      split_terms = jnp.split(all_terms, np.cumsum(stencil_sizes), axis=-1)
-      index = list(derivatives).index(key)
-      return jnp.sum(split_terms[index], axis=-1, keepdims=True)
+      segment = (Ellipsis, segments[key])
+      return jnp.sum(coefficients[segment] * all_patches[segment], axis=-1,
+                     keepdims=True)
     else:
       patches = derivatives[key].extract_patches(inputs)
-      return layers_util.apply_coefficients(coefficients_map[key], patches)
+      return layers_util.apply_coefficients(coefficients, patches)
+
+  if rematerialize_patches:
+    apply_to_patches = jax.checkpoint(apply_to_patches, static_argnums=(0,))
+
+  @functools.partial(jax.named_call, name='evaluate_derivatives')
+  def evaluate(key, inputs):
+    coefficients = all_coefficients if fuse_patches else coefficients_map[key]
+    return apply_to_patches(key, inputs, coefficients)
 
   return {k: functools.partial(evaluate, k) for k in derivatives}
 
@@ -743,16 +1168,16 @@ class SpatialDerivative:
   @functools.partial(jax.named_call, name='SpatialDerivative')
   def __call__(self, inputs, *auxiliary_inputs):
     """Computes spatial derivative of `inputs` evaluated at `offset`."""
-    # TODO(jamieas): consider moving this roll inside `extract_patches`. For the
-    # `roll` implementation of `extract_patches`, we can simply add it to the
-    # `shifts`. For the `conv` implementation, we may be able to effectively
-    # roll the input by adjusting how arrays are padded.
-    rolled = jnp.roll(inputs, self._roll)
+    # the roll is folded into the extraction of patches, but the coefficients
+    # are still computed from rolled inputs.
     patches = layers_util.extract_patches(
-        rolled, self._stencil_shape,
-        self._extract_patch_method, self._tile_layout)
+        inputs, self._stencil_shape,
+        self._extract_patch_method, self._tile_layout, roll=self._roll)
+    roll_axes = tuple(range(len(self._roll)))
+    rolled = jnp.roll(inputs, self._roll, roll_axes)
     if auxiliary_inputs is not None:
-      auxiliary_inputs = [jnp.roll(aux, self._roll) for aux in auxiliary_inputs]
+      auxiliary_inputs = [
+          jnp.roll(aux, self._roll, roll_axes) for aux in auxiliary_inputs]
       rolled = jnp.concatenate([rolled, *auxiliary_inputs], axis=-1)
     coefficients = self._coefficients_module(rolled)
     return layers_util.apply_coefficients(coefficients, patches)
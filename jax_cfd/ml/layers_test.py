@@ -7,6 +7,7 @@ from absl.testing import parameterized
 import haiku as hk
 import jax
 import jax.numpy as jnp
+from jax_cfd.base import boundaries
 from jax_cfd.base import grids
 from jax_cfd.base import test_util
 from jax_cfd.ml import layers
@@ -155,12 +156,115 @@ class ConvPeriodicTest(test_util.TestCase):
     tiled_module = lambda x: conv_module(**kwargs, tile_layout=tile_layout)(x)
     tiled_net = hk.without_apply_rng(hk.transform(tiled_module))
 
+    default_module = lambda x: conv_module(**kwargs)(x)
+    default_net = hk.without_apply_rng(hk.transform(default_module))
+
     params = base_net.init(jax.random.PRNGKey(42), inputs)
 
     base_out = base_net.apply(params, inputs)
     tiled_out = tiled_net.apply(params, inputs)
+    default_out = default_net.apply(params, inputs)
 
     np.testing.assert_allclose(base_out, tiled_out, atol=1e-6)
+    np.testing.assert_allclose(base_out, default_out, atol=1e-6)
+
+  @parameterized.named_parameters(
+      ('1d', layers.PeriodicConv1D, (16, 3), (5,), 1),
+      ('2d', layers.PeriodicConv2D, (12, 16, 2), (7, 4), 1),
+      ('2d_rate_2', layers.PeriodicConv2D, (12, 16, 2), (3, 4), 2),
+      ('3d', layers.PeriodicConv3D, (8, 8, 8, 2), (5, 5, 3), 1),
+  )
+  def test_fft_convolution(self, conv_module, input_shape, kernel_shape, rate):
+    inputs = np.random.uniform(size=input_shape).astype(np.float32)
+
+    def base_module(x):
+      return conv_module(4, kernel_shape, rate=rate, name='conv')(x)
+
+    def fft_module(x):
+      module = conv_module(
+          4, kernel_shape, rate=rate, fft_kernel_threshold=1, name='conv')
+      return module(x)
+
+    base_net = hk.without_apply_rng(hk.transform(base_module))
+    fft_net = hk.without_apply_rng(hk.transform(fft_module))
+
+    # both paths hold the same parameters.
+    params = base_net.init(jax.random.PRNGKey(42), inputs)
+    self.assertEqual(
+        jax.tree.structure(params),
+        jax.tree.structure(fft_net.init(jax.random.PRNGKey(42), inputs)))
+
+    base_out = base_net.apply(params, inputs)
+    fft_out = fft_net.apply(params, inputs)
+
+    np.testing.assert_allclose(base_out, fft_out, atol=1e-5)
+
+  @parameterized.named_parameters([
+      ('1d', layers.PeriodicConv1D, (16, 3), (3,), 'conv1_d'),
+      ('2d', layers.PeriodicConv2D, (8, 8, 3), (3, 3), 'conv2_d'),
+      ('3d', layers.PeriodicConv3D, (8, 8, 8, 3), (3, 3, 3), 'conv3_d'),
+  ])
+  def test_parameter_paths(self, conv_module, input_shape, kernel_shape,
+                           scope):
+    inputs = np.random.uniform(size=input_shape).astype(np.float32)
+    for fft_kernel_threshold in [None, 1]:
+      net = hk.transform(lambda x: conv_module(  # pylint: disable=cell-var-from-loop
+          4, kernel_shape, fft_kernel_threshold=fft_kernel_threshold,
+          name='conv')(x))
+      params = net.init(jax.random.PRNGKey(42), inputs)
+      # matches the layout of checkpoints saved when wrapping `hk.ConvND`.
+      self.assertEqual(
+          jax.tree.map(np.shape, params),
+          {f'conv/~/{scope}': {'w': kernel_shape + (3, 4), 'b': (4,)}})
+
+  @parameterized.named_parameters([
+      ('1d_stride_1', layers.PeriodicConvTranspose1D, (15, 3), (3,), 1),
+      ('1d_stride_3', layers.PeriodicConvTranspose1D, (15, 3), (4,), 3),
+      ('2d_stride_2', layers.PeriodicConvTranspose2D, (6, 8, 2), (5, 4), 2),
+      ('3d_stride_2', layers.PeriodicConvTranspose3D, (4, 4, 6, 2), (3, 4, 5),
+       2),
+  ])
+  def test_fft_transpose_convolution(
+      self, conv_module, input_shape, kernel_shape, stride):
+    inputs = np.random.uniform(size=input_shape).astype(np.float32)
+
+    def base_module(x):
+      return conv_module(4, kernel_shape, stride=stride, name='conv')(x)
+
+    def fft_module(x):
+      module = conv_module(
+          4, kernel_shape, stride=stride, fft_kernel_threshold=1, name='conv')
+      return module(x)
+
+    base_net = hk.without_apply_rng(hk.transform(base_module))
+    fft_net = hk.without_apply_rng(hk.transform(fft_module))
+
+    # both paths hold the same parameters.
+    params = base_net.init(jax.random.PRNGKey(42), inputs)
+    self.assertEqual(
+        jax.tree.structure(params),
+        jax.tree.structure(fft_net.init(jax.random.PRNGKey(42), inputs)))
+
+    base_out = base_net.apply(params, inputs)
+    fft_out = fft_net.apply(params, inputs)
+
+    np.testing.assert_allclose(base_out, fft_out, atol=1e-5)
+
+  @parameterized.named_parameters([
+      ('kernel_4', (4,), 1),
+      ('kernel_5', (5,), 1),
+      ('kernel_7_stride_2', (7,), 2),
+  ])
+  def test_transpose_kernel_larger_than_inputs(self, kernel_shape, stride):
+    inputs = np.random.uniform(size=(3, 2)).astype(np.float32)
+    net = hk.without_apply_rng(hk.transform(
+        lambda x: layers.PeriodicConvTranspose1D(2, kernel_shape, stride)(x)))
+    params = net.init(jax.random.PRNGKey(42), inputs)
+    # the result on periodic inputs matches that on their periodic images.
+    tiled_inputs = np.tile(inputs, (3, 1))
+    actual = net.apply(params, inputs)
+    expected = net.apply(params, tiled_inputs)[:actual.shape[0]]
+    np.testing.assert_allclose(actual, expected, atol=1e-5)
 
   @parameterized.named_parameters([
       ('size_60_stride_1', 60, 1),
@@ -199,6 +303,51 @@ class ConvPeriodicTest(test_util.TestCase):
     np.testing.assert_allclose(output, expected_output)
 
 
+class NonPeriodicConvTest(test_util.TestCase):
+
+  def test_output_shape(self):
+    inputs = np.random.uniform(size=(16, 3)).astype(np.float32)
+    net = hk.without_apply_rng(hk.transform(
+        lambda x: layers.NonPeriodicConv1D(4, (3,), name='conv')(x)))
+    params = net.init(jax.random.PRNGKey(42), inputs)
+    self.assertEqual(list(params), ['conv/~/conv1_d'])
+    self.assertEqual(net.apply(params, inputs).shape, (14, 4))
+
+
+class ConvMirrorTest(test_util.TestCase):
+  """Tests convolutions with mirror padding."""
+
+  @parameterized.named_parameters(
+      ('3x3', (3, 3)),
+      ('1x3', (1, 3)),
+      ('5x3', (5, 3)),
+  )
+  def test_identity_kernel(self, kernel_shape):
+    """Tests that a centered delta kernel reproduces the inputs."""
+    grid = grids.Grid((8, 10), domain=((0, 1), (0, 1)))
+    bc = boundaries.dirichlet_boundary_conditions(grid.ndim)
+    rng = np.random.RandomState(0)
+    inputs = tuple(
+        bc.impose_bc(grids.GridArray(
+            rng.uniform(size=grid.shape).astype(np.float32),
+            grid.cell_center, grid))
+        for _ in range(2))
+    w = np.zeros(kernel_shape + (2, 2), np.float32)
+    for i in range(2):
+      w[tuple(k // 2 for k in kernel_shape) + (i, i)] = 1.
+
+    def net_forward(v):
+      return layers.MirrorConv2D(
+          2, kernel_shape, w_init=hk.initializers.Constant(w))(v)
+
+    net = hk.without_apply_rng(hk.transform(net_forward))
+    params = net.init(jax.random.PRNGKey(42), inputs)
+    outputs = net.apply(params, inputs)
+    for output, expected in zip(outputs, inputs):
+      self.assertEqual(output.offset, expected.offset)
+      np.testing.assert_allclose(output.data, expected.data, atol=1e-6)
+
+
 class RescaleToRangeTest(test_util.TestCase):
   """Tests `rescale_to_range` layer."""
 
@@ -237,14 +386,46 @@ class RescaleToRangeTest(test_util.TestCase):
     input_values = np.random.uniform(low=-5., high=5., size=num_elements)
     input_values[0] = -10.
     input_values[-1] = 10.
-    input_values = np.reshape(input_values, newshape=shape)
+    input_values = np.reshape(input_values, shape).astype(np.float32)
     rescale = functools.partial(
         layers.rescale_to_range, min_value=min_value, max_value=max_value,
         axes=axes)
     # we can also not even call net_init, since no parameters are needed.
     actual_output = rescale(input_values)
     expected_output = (input_values + 10.) / 20.
-    self.assertAllClose(expected_output, actual_output)
+    self.assertAllClose(expected_output, actual_output, rtol=1e-6)
+
+  @parameterized.named_parameters([
+      ('int32', np.int32),
+      ('uint8', np.uint8),
+  ])
+  def test_integer_inputs(self, dtype):
+    inputs = np.arange(12, dtype=dtype).reshape(3, 4)
+    actual_output = layers.rescale_to_range(inputs, 0., 1., (0, 1))
+    expected_output = inputs / 11.
+    self.assertAllClose(expected_output, actual_output, rtol=1e-6)
+
+  @parameterized.named_parameters([
+      ('distinct', [0., 3., 1., 2.]),
+      ('tied_max', [1., 1., 0., 1.]),
+      ('tied_min', [0., 2., 0., 1.]),
+  ])
+  def test_gradient(self, values):
+    """Tests that gradients match those of `jnp.min` and `jnp.max`."""
+    inputs = jnp.array([values, values[::-1]]).T
+    weights = jnp.arange(inputs.size, dtype=inputs.dtype).reshape(inputs.shape)
+
+    def expected_rescale(x, axes):
+      x_max = jnp.max(x, axis=axes, keepdims=True)
+      x_min = jnp.min(x, axis=axes, keepdims=True)
+      return (x - x_min) / ((x_max - x_min) / 2.) - 1.
+
+    for axes in [(0,), (0, 1)]:
+      actual = jax.grad(lambda x: jnp.sum(weights * layers.rescale_to_range(  # pylint: disable=cell-var-from-loop
+          x, -1., 1., axes)))(inputs)
+      expected = jax.grad(lambda x: jnp.sum(weights * expected_rescale(  # pylint: disable=cell-var-from-loop
+          x, axes)))(inputs)
+      self.assertAllClose(expected, actual, atol=1e-5)
 
 
 def _name_test(ndim, stencil, derivs):
@@ -325,6 +506,22 @@ class PolynomialConstraintTest(test_util.TestCase):
     violation = jnp.transpose(jnp.tensordot(a, outputs, axes=[-1, -1])) - b
     np.testing.assert_allclose(jnp.max(violation), 0., atol=1e-2)
 
+  def test_low_precision_nullspace(self):
+    grid_step = 0.1
+    steps = (grid_step,) * 2
+    stencils = [_make_test_stencil(4, grid_step)] * 2
+    method = layers_util.Method.FINITE_VOLUME
+    module = layers.PolynomialConstraint(
+        stencils, (1, 0), method, steps)
+    bf16_module = layers.PolynomialConstraint(
+        stencils, (1, 0), method, steps, nullspace_dtype=jnp.bfloat16)
+    inputs = np.random.uniform(
+        size=(8, 8, module.subspace_size)).astype(np.float32)
+    expected = module(inputs)
+    actual = bf16_module(inputs)
+    self.assertEqual(actual.dtype, expected.dtype)
+    np.testing.assert_allclose(actual, expected, rtol=1e-2, atol=1e-1)
+
 
 def _tower_factory(num_output_channels, ndims, conv_block):
   rescale_01 = functools.partial(layers.rescale_to_range, min_value=0.,
@@ -412,6 +609,72 @@ class SpatialDerivativeFromLogitsTest(test_util.TestCase):
         expected_shape = input_shape + (1,)
         self.assertArrayEqual(expected_shape, derivative.shape)
 
+  @parameterized.parameters(
+      dict(fuse_patches=False, constrain_with_conv=False, tile_layout=None),
+      dict(fuse_patches=True, constrain_with_conv=False, tile_layout=None),
+      dict(fuse_patches=True, constrain_with_conv=True, tile_layout=(1, 1)),
+      dict(fuse_patches=False, constrain_with_conv=False, tile_layout=None,
+           sparse_constraints=True),
+      dict(fuse_patches=False, constrain_with_conv=False, tile_layout=None,
+           nullspace_dtype=jnp.bfloat16),
+      dict(fuse_patches=False, constrain_with_conv=False, tile_layout=None,
+           sparse_constraints=True, nullspace_dtype=jnp.bfloat16),
+      dict(fuse_patches=True, constrain_with_conv=True, tile_layout=(1, 1),
+           nullspace_dtype=jnp.bfloat16),
+  )
+  def test_fused_layers(self, fuse_patches, constrain_with_conv, tile_layout,
+                        sparse_constraints=False, nullspace_dtype=None):
+    input_shape = (16, 16)
+    input_offset = (.5, .5)
+    derivatives = {
+        target_offset: layers.SpatialDerivativeFromLogits(
+            (4, 4), input_offset, target_offset, (0, 0), (.1, .1),
+            tile_layout=tile_layout, nullspace_dtype=nullspace_dtype)
+        for target_offset in [(1., .5), (.5, 1.), (.5, .5)]
+    }
+    output_sizes = [deriv.subspace_size for deriv in derivatives.values()]
+    rng = np.random.RandomState(0)
+    inputs = rng.uniform(size=input_shape + (1,)).astype(np.float32)
+    all_logits = rng.normal(
+        size=input_shape + (sum(output_sizes),)).astype(np.float32)
+    split_logits = jnp.split(all_logits, np.cumsum(output_sizes), axis=-1)
+
+    fused = layers.fuse_spatial_derivative_layers(
+        derivatives, all_logits, fuse_patches=fuse_patches,
+        constrain_with_conv=constrain_with_conv,
+        sparse_constraints=sparse_constraints)
+    for (key, derivative), logits in zip(derivatives.items(), split_logits):
+      with self.subTest(str(key)):
+        expected = derivative(inputs, logits)
+        actual = fused[key](inputs)
+        np.testing.assert_allclose(actual, expected, atol=1e-4, rtol=1e-4)
+
+  @parameterized.parameters(dict(fuse_patches=False), dict(fuse_patches=True))
+  def test_rematerialize_patches(self, fuse_patches):
+    input_shape = (16, 16)
+    derivatives = {
+        target_offset: layers.SpatialDerivativeFromLogits(
+            (4, 4), (.5, .5), target_offset, (0, 0), (.1, .1))
+        for target_offset in [(1., .5), (.5, 1.)]
+    }
+    output_size = sum(deriv.subspace_size for deriv in derivatives.values())
+    rng = np.random.RandomState(0)
+    inputs = rng.uniform(size=input_shape + (1,)).astype(np.float32)
+    all_logits = rng.normal(
+        size=input_shape + (output_size,)).astype(np.float32)
+
+    def loss(inputs, all_logits, rematerialize_patches):
+      fused = layers.fuse_spatial_derivative_layers(
+          derivatives, all_logits, fuse_patches=fuse_patches,
+          rematerialize_patches=rematerialize_patches)
+      return sum(jnp.sum(evaluate(inputs) ** 2) for evaluate in fused.values())
+
+    grad_fn = jax.grad(loss, argnums=(0, 1))
+    expected = grad_fn(inputs, all_logits, False)
+    actual = grad_fn(inputs, all_logits, True)
+    for actual_grad, expected_grad in zip(actual, expected):
+      np.testing.assert_allclose(actual_grad, expected_grad, rtol=1e-5)
+
 
 class SpatialDerivativeTest(test_util.TestCase):
   """Tests SpatialDerivative module."""
@@ -3,7 +3,7 @@ import enum
 import functools
 import itertools
 import math
-from typing import Iterator, Optional, Sequence, Tuple, Union
+from typing import Any, Iterator, Optional, Sequence, Tuple, Union
 
 import jax
 from jax import lax
@@ -313,10 +313,19 @@ def periodic_convolution(
     kernel: Array,
     tile_layout: Optional[Tuple[int, ...]] = None,
     precision: PrecisionLike = lax.Precision.HIGHEST,
+    roll: Optional[Tuple[int, ...]] = None,
+    preferred_element_type: Optional[Any] = None,
 ) -> Array:
-  """Applies a periodic convolution."""
+  """Applies a periodic convolution, optionally to `jnp.roll(x, roll, axes)`."""
   num_spatial_dims = kernel.ndim - 2
   padding = _get_padding(kernel.shape)
+  if roll is not None and any(roll):
+    if tile_layout is None:
+      # rolling the inputs is equivalent to shifting the periodic padding.
+      padding = tuple((pad_left + r, pad_right - r)
+                      for (pad_left, pad_right), r in zip(padding, roll))
+    else:
+      x = jnp.roll(x, roll, range(len(roll)))
   strides = [1] * num_spatial_dims
   dimension_numbers = _DIMENSION_NUMBERS[num_spatial_dims]
   conv = functools.partial(jax.lax.conv_general_dilated,
@@ -324,7 +333,8 @@ def periodic_convolution(
                            window_strides=strides,
                            padding='VALID',
                            dimension_numbers=dimension_numbers,
-                           precision=precision)
+                           precision=precision,
+                           preferred_element_type=preferred_element_type)
   return tiling.apply_convolution(conv, x, layout=tile_layout, padding=padding)
 
 
@@ -345,10 +355,11 @@ def _patch_kernel(  # pytype: disable=annotation-type-mismatch  # numpy-scalars
   return np.moveaxis(kernel_nd, (0, 1), (-1, -2))
 
 
-@functools.partial(jax.jit, static_argnums=(1,))
+@functools.partial(jax.jit, static_argnums=(1, 2))
 def _extract_patches_roll(
     x: Array,
-    patch_shape: Tuple[int, ...]
+    patch_shape: Tuple[int, ...],
+    roll: Optional[Tuple[int, ...]],
 ) -> Array:
   """Extract patches of the given shape using a vmapped `roll` operation."""
   # Computes shifts required for the given `patch_shape`.
@@ -357,30 +368,35 @@ def _extract_patches_roll(
   for size in patch_shape:
     shifts.append(range(-size // 2 + 1, size // 2 + 1))
   rolls = -np.stack(tuple(itertools.product(*shifts)))
+  if roll is not None:
+    rolls += np.array(roll)
   out_axis = x.ndim
   roll_axes = range(out_axis)
   in_axes = (None, 0, None)
   return jax.vmap(jnp.roll, in_axes, out_axis)(x, rolls, roll_axes)
 
 
-@functools.partial(jax.jit, static_argnums=(1, 2))
+@functools.partial(jax.jit, static_argnums=(1, 2, 3))
 def _extract_patches_conv(
     x: Array,
     patch_shape: Tuple[int, ...],
     tile_layout: Optional[Tuple[int, ...]],
+    roll: Optional[Tuple[int, ...]],
 ) -> Array:
   """Extract patches of the given shape using a tiled convolution."""
   kernel = _patch_kernel(patch_shape, dtype=x.dtype)
   # the kernel can be represented exactly in bfloat16
   precision = (lax.Precision.HIGHEST, lax.Precision.DEFAULT)
-  return periodic_convolution(x, kernel, tile_layout, precision=precision)
+  return periodic_convolution(
+      x, kernel, tile_layout, precision=precision, roll=roll)
 
 
 def extract_patches(
     x: Array,
     patch_shape: Tuple[int, ...],
     method: str = 'roll',
-    tile_layout: Optional[Tuple[int, ...]] = None):
+    tile_layout: Optional[Tuple[int, ...]] = None,
+    roll: Optional[Tuple[int, ...]] = None):
   """Extracts patches of given shape, stacks them along the channel dimension.
 
   For example,
@@ -416,16 +432,21 @@ def extract_patches(
       be used to perform the convolutions that extract patches. If `None`, then
       no tiling is performed. If `method == 'roll'`, this argument has not
       effect.
+    roll: optional tuple (r0, ..., rk) of integer shifts. If given, patches are
+      extracted from `jnp.roll(x, roll, range(k + 1))`, without materializing
+      the rolled array.
 
   Returns:
     An array of shape [d0, ..., dk, c] where `c = prod(patch_shape)`.
   """
+  if roll is not None:
+    roll = tuple(roll)
   # TODO(jamieas): consider removing the 'roll' method once the convolutional
   # one has been optimized.
   if method == 'roll':
-    return _extract_patches_roll(x, patch_shape)
+    return _extract_patches_roll(x, tuple(patch_shape), roll)
   elif method == 'conv':
-    return _extract_patches_conv(x, patch_shape, tile_layout)
+    return _extract_patches_conv(x, tuple(patch_shape), tile_layout, roll)
   else:
     raise ValueError(f'Unknown `method` passed to `extract_patches`: {method}.')
 
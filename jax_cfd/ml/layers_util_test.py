@@ -322,6 +322,29 @@ class ExtractPatchesTest(test_util.TestCase):
           actual_patch = patches[idx]
           np.testing.assert_allclose(actual_patch, expected_patch)
 
+  @parameterized.named_parameters(
+      dict(testcase_name='_1D', shape=(16, 1), patch_shape=(4,), roll=(3,),
+           tile_layout=None),
+      dict(testcase_name='_2D', shape=(8, 12, 1), patch_shape=(3, 4),
+           roll=(1, -2), tile_layout=None),
+      dict(testcase_name='_2D_tiled', shape=(8, 12, 1), patch_shape=(3, 3),
+           roll=(1, 0), tile_layout=(2, 2)),
+      dict(testcase_name='_3D', shape=(6, 6, 6, 1), patch_shape=(2, 3, 2),
+           roll=(1, 1, 1), tile_layout=None),
+  )
+  def test_extract_patches_with_roll(self, shape, patch_shape, roll,
+                                     tile_layout):
+    """Tests that `roll` matches extracting patches of rolled inputs."""
+    x = np.random.uniform(size=shape).astype(np.float32)
+    rolled = np.roll(x, roll, tuple(range(len(roll))))
+    for method in ('roll', 'conv'):
+      with self.subTest(f'method_{method}'):
+        expected = layers_util.extract_patches(
+            rolled, patch_shape, method, tile_layout)
+        actual = layers_util.extract_patches(
+            x, patch_shape, method, tile_layout, roll=roll)
+        np.testing.assert_allclose(actual, expected)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -20,6 +20,7 @@ import einops
 import jax
 from jax import lax
 import jax.numpy as jnp
+import numpy as np
 
 
 Array = jnp.ndarray
@@ -112,6 +113,46 @@ def halo_exchange_pad(
       tuple(map(tuple, padding)))
 
 
+@functools.lru_cache(maxsize=None)
+def _periodic_pad_indices(
+    shape: Tuple[int, ...],
+    padding: Tuple[Tuple[int, int], ...],
+) -> Tuple[np.ndarray, ...]:
+  """Returns open-mesh indices that periodically pad an array of `shape`."""
+  indices = [
+      np.arange(-pad_left, size + pad_right) % size
+      for size, (pad_left, pad_right) in zip(shape, padding)
+  ]
+  return np.ix_(*indices)
+
+
+@functools.partial(jax.jit, static_argnums=(1,))
+def _periodic_pad(array: Array,
+                  padding: Tuple[Tuple[int, int], ...]) -> Array:
+  shape = array.shape[:len(padding)]
+  return array[_periodic_pad_indices(shape, padding)]
+
+
+def periodic_pad(
+    array: Array,
+    padding: Sequence[Tuple[int, int]],
+) -> Array:
+  """Periodically pad the leading spatial dimensions of `array`.
+
+  Unlike `jnp.pad(..., mode='wrap')`, which concatenates slices along one axis
+  at a time, this gathers the padded array in a single indexing operation.
+
+  Args:
+    array: array of shape [[spatial dims], channel].
+    padding: amount of periodic padding to add before and after each spatial
+      dimension.
+
+  Returns:
+    Padded array.
+  """
+  return _periodic_pad(array, tuple(map(tuple, padding)))
+
+
 @functools.partial(jax.jit, static_argnums=(1,))
 def space_to_batch(array: Array, layout: Tuple[int, ...]) -> Array:
   """Rearrange from space to batch dimensions."""
@@ -163,7 +204,8 @@ def apply_convolution(
   """
   if layout is None:
     # TODO(shoyer): replace this with some sensible heuristic
-    layout = (1,) * len(padding)
+    padded = periodic_pad(inputs, padding)
+    return conv(padded[jnp.newaxis])[0]
   tiled = space_to_batch(inputs, layout)
   padded = halo_exchange_pad(tiled, layout, padding)
   convolved = conv(padded)